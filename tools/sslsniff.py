@@ -17,7 +17,10 @@ from __future__ import print_function
 from bcc import BPF
 import argparse
 import binascii
-import textwrap
+import io
+import platform
+import re
+import sys
 
 # arguments
 examples = """examples:
@@ -49,30 +52,100 @@ parser.add_argument("--ebpf", action="store_true",
                     help=argparse.SUPPRESS)
 parser.add_argument("--hexdump", action="store_true", dest="hexdump",
                     help="show data as hexdump instead of trying to decode it as UTF-8")
+parser.add_argument("--text", action="store_true",
+                    help="treat payloads as NUL-terminated text and stop "
+                         "capturing at the first NUL, as in HTTP/1.x over "
+                         "TLS (uses bpf_probe_read_user_str)")
+parser.add_argument("--max-rate", type=int, default=0,
+                    help="limit each PID to this many events per second, "
+                         "dropping the rest in the kernel "
+                         "(default: unlimited)")
+parser.add_argument("--pages", type=int, default=128,
+                    help="number of pages for the event buffer, per CPU for "
+                         "perf buffers (default: %(default)d, must be a "
+                         "power of two)")
 args = parser.parse_args()
 
+if args.max_rate < 0:
+    parser.error("--max-rate must be positive")
+
 
 prog = """
 #include <linux/ptrace.h>
 #include <linux/sched.h>        /* For TASK_COMM_LEN */
 
+/* Runtime configuration is injected here as preprocessor defines
+ * (FILTER_PID, FILTER_COMM, RATE_INTERVAL_NS, TEXT_MODE) so that disabled
+ * features compile away entirely and enabled ones fold against
+ * literal constants. */
+DEFINES
+
 struct probe_SSL_data_t {
         u64 timestamp_ns;
         u32 pid;
         char comm[TASK_COMM_LEN];
+        u32 len;        /* what the SSL call saw */
+        u32 buf_len;    /* how much of it sits in v0 */
+        u8 rw;
         char v0[MAX_BUF_SIZE];
-        u32 len;
 };
 
+/* Submit only the header plus the bytes actually captured in v0,
+ * not the whole fixed-size struct. */
+#define BASE_EVENT_SIZE ((size_t)(&((struct probe_SSL_data_t *)0)->v0))
+#define EVENT_SIZE(X) (BASE_EVENT_SIZE + ((size_t)(X)))
+
 BPF_PERCPU_ARRAY(data_map, struct probe_SSL_data_t, 1);
 
-BPF_PERF_OUTPUT(perf_SSL_write);
+#ifdef RATE_INTERVAL_NS
+BPF_HASH(rate, u32, u64);
+#endif
+
+static inline int trace_allowed(u32 pid) {
+#ifdef FILTER_PID
+        if ( pid != FILTER_PID ) {
+                return 0;
+        }
+#endif
+#ifdef FILTER_COMM
+        char needle[TASK_COMM_LEN] = FILTER_COMM;
+        char comm[TASK_COMM_LEN];
+        bpf_get_current_comm(&comm, sizeof(comm));
+        #pragma unroll
+        for (int i = 0; i < TASK_COMM_LEN; i++) {
+                if (comm[i] != needle[i]) { return 0; }
+                if (comm[i] == '\\0') { break; }
+        }
+#endif
+        return 1;
+}
+
+EVENT_OUTPUT
 
 int probe_SSL_write(struct pt_regs *ctx, void *ssl, void *buf, u32 num) {
         u64 pid_tgid = bpf_get_current_pid_tgid();
         u32 pid = pid_tgid >> 32;
 
-        FILTER
+        if ( !trace_allowed(pid) ) {
+                return 0;
+        }
+
+        /* Zero-length writes and error returns carry no payload; drop
+         * them before doing any event work. */
+        if ( (int)num <= 0 ) {
+                return 0;
+        }
+
+#ifdef RATE_INTERVAL_NS
+        u64 now = bpf_ktime_get_ns();
+        u64 *last = rate.lookup(&pid);
+
+        if (last && now - *last < RATE_INTERVAL_NS) {
+                return 0;
+        }
+
+        rate.update(&pid, &now);
+#endif
 
         u32 zero = 0;
         struct probe_SSL_data_t *__data = data_map.lookup(&zero);
@@ -84,37 +157,57 @@ int probe_SSL_write(struct pt_regs *ctx, void *ssl, void *buf, u32 num) {
         __data->timestamp_ns = bpf_ktime_get_ns();
         __data->pid = pid;
         __data->len = num;
+        __data->rw = 0;
 
-        if ( num == 4294967295 ) {
-                return 0;
-        }
-
-        u32 size = ( num > MAX_BUF_SIZE - 1 ) ? (MAX_BUF_SIZE-1) : num;
+        u32 size = ( num > MAX_BUF_SIZE ) ? MAX_BUF_SIZE : num;
 
         bpf_get_current_comm(&__data->comm, sizeof(__data->comm));
 
         if ( buf != 0) {
+#ifdef TEXT_MODE
+                int r = bpf_probe_read_user_str(&__data->v0, size, buf);
+
+                if (r > 0) {
+                        size = r - 1;
+                }
+#else
                 bpf_probe_read_user(&__data->v0, size, buf);
+#endif
         }
 
-        __data->v0[size] = 0;
+        __data->buf_len = size;
 
-        perf_SSL_write.perf_submit(ctx, __data, sizeof(*__data));
+        submit_event(ctx, __data, size);
         return 0;
 }
 
-BPF_PERF_OUTPUT(perf_SSL_read);
+/* SSL_read's buffer argument isn't available in the return probe, and
+ * the call routinely blocks in between, so stash the pointer per tid
+ * at function entry. The comm is captured alongside it to spare the
+ * exit probe the helper call - it can't change between entry and
+ * return of the same call. */
+struct ssl_read_args_t {
+        u64 buf;
+        char comm[TASK_COMM_LEN];
+};
 
-BPF_HASH(bufs, u32, u64);
+BPF_HASH(read_args, u32, struct ssl_read_args_t);
 
 int probe_SSL_read_enter(struct pt_regs *ctx, void *ssl, void *buf, int num) {
         u64 pid_tgid = bpf_get_current_pid_tgid();
         u32 pid = pid_tgid >> 32;
         u32 tid = (u32)pid_tgid;
 
-        FILTER
+        if ( !trace_allowed(pid) ) {
+                return 0;
+        }
+
+        struct ssl_read_args_t args = {};
+
+        args.buf = (u64)buf;
+        bpf_get_current_comm(&args.comm, sizeof(args.comm));
 
-        bufs.update(&tid, (u64*)&buf);
+        read_args.update(&tid, &args);
         return 0;
 }
 
@@ -123,41 +216,75 @@ int probe_SSL_read_exit(struct pt_regs *ctx, void *ssl, void *buf, int num) {
         u32 pid = pid_tgid >> 32;
         u32 tid = (u32)pid_tgid;
 
-        FILTER
+#ifdef FILTER_PID
+        /* The comm filter already ran at entry; an entry under our tid
+         * implies it passed, so only the pid needs re-checking. */
+        if ( pid != FILTER_PID ) {
+                return 0;
+        }
+#endif
+
+        struct ssl_read_args_t *args = read_args.lookup(&tid);
 
-        u64 *bufp = bufs.lookup(&tid);
-        if (bufp == 0) {
+        if ( !args ) {
                 return 0;
         }
 
-        u32 zero = 0;
-        struct probe_SSL_data_t *__data = data_map.lookup(&zero);
+        /* EOF and error returns carry no payload; drop them before any
+         * further event work. */
+        int ret = PT_REGS_RC(ctx);
 
-        if ( !__data ) {
+        if ( ret <= 0 ) {
+                read_args.delete(&tid);
                 return 0;
         }
 
-        __data->timestamp_ns = bpf_ktime_get_ns();
-        __data->pid = pid;
-        __data->len = PT_REGS_RC(ctx);
+#ifdef RATE_INTERVAL_NS
+        u64 now = bpf_ktime_get_ns();
+        u64 *last = rate.lookup(&pid);
 
-        if ( __data->len == 4294967295 ) {
+        if (last && now - *last < RATE_INTERVAL_NS) {
+                read_args.delete(&tid);
                 return 0;
         }
 
-        bpf_get_current_comm(&__data->comm, sizeof(__data->comm));
+        rate.update(&pid, &now);
+#endif
 
-        u32 size = ( __data->len > MAX_BUF_SIZE - 1 ) ? (MAX_BUF_SIZE - 1): __data->len;
+        u32 zero = 0;
+        struct probe_SSL_data_t *__data = data_map.lookup(&zero);
 
-        if (bufp != 0) {
-                bpf_probe_read_user(&__data->v0, size, (char *)*bufp);
+        if ( !__data ) {
+                return 0;
         }
 
-        __data->v0[size] = 0;
+        u64 buf_ptr = args->buf;
+        __builtin_memcpy(__data->comm, args->comm, sizeof(__data->comm));
+        read_args.delete(&tid);
+
+        __data->timestamp_ns = bpf_ktime_get_ns();
+        __data->pid = pid;
+        __data->len = ret;
+        __data->rw = 1;
+
+        u32 size = ( __data->len > MAX_BUF_SIZE ) ? MAX_BUF_SIZE : __data->len;
+
+        if (buf_ptr != 0) {
+#ifdef TEXT_MODE
+                int r = bpf_probe_read_user_str(&__data->v0, size,
+                                                (char *)buf_ptr);
+
+                if (r > 0) {
+                        size = r - 1;
+                }
+#else
+                bpf_probe_read_user(&__data->v0, size, (char *)buf_ptr);
+#endif
+        }
 
-        bufs.delete(&tid);
+        __data->buf_len = size;
 
-        perf_SSL_read.perf_submit(ctx, __data, sizeof(*__data));
+        submit_event(ctx, __data, size);
         return 0;
 }
 """
@@ -167,10 +294,81 @@ TASK_COMM_LEN = 16  # linux/sched.h
 MAX_BUF_SIZE = 1024 * 8
 
 
-if args.pid:
-    prog = prog.replace('FILTER', 'if (pid != %d) { return 0; }' % args.pid)
+def kernel_version_ge(major, minor):
+    # True if the running kernel is at least major.minor. Trailing local
+    # version parts ("5.15.0-84-generic") are ignored.
+    match = re.match(r'^(\d+)\.(\d+)', platform.release())
+    if not match:
+        return False
+    return (int(match.group(1)), int(match.group(2))) >= (major, minor)
+
+
+# A single shared BPF ring buffer (Linux 5.8+) is cheaper than one perf
+# buffer per CPU: events are written once instead of being spread over
+# per-CPU mmap'd pages, and userspace polls one fd instead of one per CPU.
+use_ringbuf = kernel_version_ge(5, 8)
+
+# Wake userspace up only every WAKEUP_EVENTS records (or on a large
+# record) instead of on every submit; the poll loop below drains the
+# ring on a timeout so batched records are still picked up promptly.
+WAKEUP_EVENTS = 16
+
+ringbuf_output = """
+BPF_RINGBUF_OUTPUT(events, PAGE_CNT);
+
+BPF_PERCPU_ARRAY(wakeup_cnt, u32, 1);
+
+static inline void submit_event(struct pt_regs *ctx,
+                                struct probe_SSL_data_t *data, u32 size) {
+        u64 flags = BPF_RB_NO_WAKEUP;
+        u32 zero = 0;
+        u32 *cnt = wakeup_cnt.lookup(&zero);
+
+        if (cnt) {
+                (*cnt)++;
+                if (*cnt >= WAKEUP_EVENTS || size > MAX_BUF_SIZE / 2) {
+                        *cnt = 0;
+                        flags = BPF_RB_FORCE_WAKEUP;
+                }
+        }
+
+        events.ringbuf_output(data, EVENT_SIZE(size), flags);
+}
+"""
+
+perf_output = """
+BPF_PERF_OUTPUT(events);
+
+static inline void submit_event(struct pt_regs *ctx,
+                                struct probe_SSL_data_t *data, u32 size) {
+        events.perf_submit(ctx, data, EVENT_SIZE(size));
+}
+"""
+
+if use_ringbuf:
+    prog = prog.replace('EVENT_OUTPUT', ringbuf_output)
+    prog = prog.replace('PAGE_CNT', '%d' % args.pages)
+    prog = prog.replace('WAKEUP_EVENTS', '%d' % WAKEUP_EVENTS)
 else:
-    prog = prog.replace('FILTER', '')
+    prog = prog.replace('EVENT_OUTPUT', perf_output)
+
+# Specialize the program through preprocessor constants rather than by
+# splicing expression snippets into the probe bodies: features that are
+# off contribute no code at all, and the compiler folds the enabled
+# checks against literal constants.
+defines = []
+if args.pid:
+    defines.append('#define FILTER_PID %d' % args.pid)
+if args.comm:
+    defines.append('#define FILTER_COMM "%s"' %
+                   args.comm[:TASK_COMM_LEN - 1].replace('\\', '\\\\')
+                                                .replace('"', '\\"'))
+if args.max_rate:
+    defines.append('#define RATE_INTERVAL_NS %d' %
+                   (1000000000 // args.max_rate))
+if args.text:
+    defines.append('#define TEXT_MODE')
+prog = prog.replace('DEFINES', '\n'.join(defines))
 
 prog = prog.replace('MAX_BUF_SIZE', '%d' % MAX_BUF_SIZE)
 
@@ -217,6 +415,12 @@ if args.nss:
                        fn_name="probe_SSL_read_exit", pid=args.pid or -1)
 
 
+# On a terminal stdout is line buffered, costing one write() syscall
+# per output line. Rebind it to a plain 64 KiB buffer and flush once
+# per poll below, so a burst of events amortizes to a single write().
+sys.stdout = io.TextIOWrapper(open(1, 'wb', closefd=False, buffering=65536),
+                              write_through=False)
+
 # header
 print("%-12s %-18s %-16s %-7s %-6s" % ("FUNC", "TIME(s)", "COMM", "PID",
                                        "LEN"))
@@ -224,51 +428,89 @@ print("%-12s %-18s %-16s %-7s %-6s" % ("FUNC", "TIME(s)", "COMM", "PID",
 # process event
 start = 0
 
+rw_str = {0: "WRITE/SEND", 1: "READ/RECV"}
 
-def print_event_write(cpu, data, size):
-    print_event(cpu, data, size, "WRITE/SEND", "perf_SSL_write")
-
+# Resolve the output table and its event decoder once; going through
+# b["events"].event on every callback redoes the table lookup and
+# attribute traversal on the hot path.
+events_table = b["events"]
+decode_event = events_table.event
 
-def print_event_read(cpu, data, size):
-    print_event(cpu, data, size, "READ/RECV", "perf_SSL_read")
+# Offset of v0 inside the event struct; filled in on the first event,
+# once the ctypes class exists.
+v0_offset = None
 
 
-def print_event(cpu, data, size, rw, evt):
-    global start
-    event = b[evt].event(data)
+def print_event(cpu, data, size):
+    global start, v0_offset
+    event = decode_event(data)
+    rw = rw_str[event.rw]
 
-    # Filter events by command
-    if args.comm:
-        if not args.comm == event.comm.decode('utf-8', 'replace'):
-            return
+    if v0_offset is None:
+        v0_offset = type(event).v0.offset
 
     if start == 0:
         start = event.timestamp_ns
     time_s = (float(event.timestamp_ns - start)) / 1000000000
 
+    # Only header + captured payload bytes are submitted; buf_len says
+    # how many of them are in v0 (it can be less than len when the
+    # payload was clamped, or stopped at a NUL in --text mode). v0 is a
+    # ctypes char array whose attribute access would copy all of it and
+    # truncate at the first NUL, so pull the payload through a zero-copy
+    # view of exactly buf_len bytes instead.
+    buf_size = min(event.buf_len, MAX_BUF_SIZE)
+    buf = bytes(memoryview(event).cast('B')[v0_offset:v0_offset + buf_size])
+
     s_mark = "-" * 5 + " DATA " + "-" * 5
 
     e_mark = "-" * 5 + " END DATA " + "-" * 5
 
-    truncated_bytes = event.len - MAX_BUF_SIZE
+    truncated_bytes = event.len - buf_size
     if truncated_bytes > 0:
         e_mark = "-" * 5 + " END DATA (TRUNCATED, " + str(truncated_bytes) + \
                 " bytes lost) " + "-" * 5
 
-    fmt = "%-12s %-18.9f %-16s %-7d %-6d\n%s\n%s\n%s\n\n"
+    fmt = "%-12s %-18.9f %-16s %-7d %-6d\n%s\n%s\n%s\n\n\n"
     if args.hexdump:
-        unwrapped_data = binascii.hexlify(event.v0)
-        data = textwrap.fill(unwrapped_data.decode('utf-8', 'replace'), width=32)
+        # The hex string has no spaces, so wrapping it is just slicing
+        # into fixed 32-char chunks; stay in bytes until the final join
+        # (hexlify output is pure ASCII).
+        hex_data = binascii.hexlify(buf)
+        data = b'\n'.join(hex_data[i:i + 32]
+                          for i in range(0, len(hex_data), 32)).decode()
     else:
-        data = event.v0.decode('utf-8', 'replace')
-    print(fmt % (rw, time_s, event.comm.decode('utf-8', 'replace'),
-                 event.pid, event.len, s_mark, data, e_mark))
+        data = buf.decode('utf-8', 'replace')
+    sys.stdout.write(fmt % (rw, time_s,
+                            event.comm.decode('utf-8', 'replace'),
+                            event.pid, event.len, s_mark, data, e_mark))
+
 
+def on_lost(lost):
+    print("Possibly lost %d events; consider raising --pages" % lost,
+          file=sys.stderr)
+
+
+if use_ringbuf:
+    events_table.open_ring_buffer(print_event)
+
+    def poll_events():
+        # Records submitted with BPF_RB_NO_WAKEUP don't notify the poll
+        # fd, so wait briefly for a forced wakeup and then drain whatever
+        # accumulated since the last pass.
+        b.ring_buffer_poll(100)
+        b.ring_buffer_consume()
+else:
+    events_table.open_perf_buffer(print_event, page_cnt=args.pages,
+                                  lost_cb=on_lost)
 
-b["perf_SSL_write"].open_perf_buffer(print_event_write)
-b["perf_SSL_read"].open_perf_buffer(print_event_read)
+    def poll_events():
+        # Poll with a timeout so buffered output - the header line in
+        # particular - is flushed even before the first event arrives.
+        b.perf_buffer_poll(timeout=100)
 while 1:
     try:
-        b.perf_buffer_poll()
+        poll_events()
+        sys.stdout.flush()
     except KeyboardInterrupt:
         exit()